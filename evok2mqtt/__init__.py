@@ -1,43 +1,45 @@
 #!/usr/bin/env python
 import argparse
 import asyncio
-import collections
-import json
+import dataclasses
+import functools
 import logging
 import logging.config
-import re
 import socket
 import sys
+import typing
 
+import orjson
 import paho.mqtt.client as mqtt
 import websockets
 
+# All work here is I/O (paho, websockets) plus a few string and dict operations
+# per message, there are no numerical loops. JIT/AOT compilers such as Numba or
+# Cython would only add import and compile time, so hot paths stay plain python
+# and are kept fast by avoiding per-message work instead.
+
 # Log setup
-LOG_LEVEL = logging.INFO
+LOG_LEVEL = logging.WARNING
 LOG_CONFIG = dict(
     version=1,
     formatters={
         "default": {"format": "%(asctime)s - %(kind)s - %(levelname)s - %(message)s"}
     },
-    handlers={
-        "stream": {
-            "class": "logging.StreamHandler",
-            "formatter": "default",
-            "level": LOG_LEVEL,
-        }
-    },
+    handlers={"stream": {"class": "logging.StreamHandler", "formatter": "default"}},
     root={"handlers": ["stream"], "level": LOG_LEVEL},
 )
 
 logging.config.dictConfig(LOG_CONFIG)
 logger = logging.getLogger(__name__)
 
+# Websocket
+WS_SEND_BATCH_SIZE = 32
+
 # MQTT
 _MQTT_CLIENT = None
 MQTT_TOPIC_FORMAT = "{device_name}/{dev}/{circuit}/{hass_action}"
-MQTT_COMMAND_TOPIC_REGEX = re.compile(
-    r"^(?P<device_name>(\w+))/(?P<dev>(relay|output))/(?P<circuit>[0-9_]+)/set$"
-)
+MQTT_COMMAND_TOPIC_FILTER = "{device_name}/+/+/set"
+MQTT_COMMAND_DEVS = frozenset(("relay", "output"))
 
 
 class HASS_ACTION:
@@ -53,152 +55,227 @@ class LOG_KIND:
 
 _SETTINGS = None
 
+# Command topic filter, used on every (re)connect
+_SUBSCRIBE_TOPIC = None
+
+
 # Settings
-Settings = collections.namedtuple(
-    "Settings",
-    (
+@dataclasses.dataclass(frozen=True)
+class Settings:
+    # Explicit __slots__, as dataclass(slots=True) needs python 3.10
+    __slots__ = (
         "MQTT_HOST",
         "MQTT_PORT",
+        "MQTT_KEEPALIVE",
         "MQTT_PAYLOAD_ON",
         "MQTT_PAYLOAD_OFF",
         "DEVICE_NAME",
         "WEBSOCKET_URI",
-    ),
-)
+        "WEBSOCKET_PING_INTERVAL",
+    )
+
+    MQTT_HOST: str
+    MQTT_PORT: int
+    MQTT_KEEPALIVE: int
+    MQTT_PAYLOAD_ON: bytes
+    MQTT_PAYLOAD_OFF: bytes
+    DEVICE_NAME: str
+    WEBSOCKET_URI: str
+    WEBSOCKET_PING_INTERVAL: typing.Optional[int]
 
 
 def _set_settings(
-    mqtt_host, mqtt_port, mqtt_payload_on, mqtt_payload_off, device_name, websocket_uri,
+    mqtt_host,
+    mqtt_port,
+    mqtt_keepalive,
+    mqtt_payload_on,
+    mqtt_payload_off,
+    device_name,
+    websocket_uri,
+    websocket_ping_interval,
 ):
     """
     Put all settings in global scope, as they don't change after intialization
     and make it easier to define callbacks
     """
-    global _SETTINGS
+    global _SETTINGS, _SUBSCRIBE_TOPIC
     if _SETTINGS is not None:
         logger.warning("Updating settings", extra={"kind": LOG_KIND.SETTINGS})
     _SETTINGS = Settings(
         mqtt_host,
         mqtt_port,
+        mqtt_keepalive,
         mqtt_payload_on,
         mqtt_payload_off,
         device_name,
         websocket_uri,
+        websocket_ping_interval,
     )
+    _SUBSCRIBE_TOPIC = MQTT_COMMAND_TOPIC_FILTER.format(device_name=device_name)
 
 
-def _settings():
-    global _SETTINGS
-    if _SETTINGS is None:
-        logger.warning(
-            "Settings haven't been initialized, this will probably not work",
-            extra={"kind": LOG_KIND.SETTINGS},
+@functools.lru_cache(maxsize=512)
+def _state_topic(device_name, dev, circuit):
+    """State topic for a given circuit, cached as the same few circuits recur"""
+    return MQTT_TOPIC_FORMAT.format(
+        device_name=device_name,
+        dev=dev,
+        circuit=circuit,
+        hass_action=HASS_ACTION.STATE,
+    )
+
+
+def _make_ws_process(publish):
+    """
+    Build the websocket payload processor with everything it needs bound as
+    closure variables, which are faster to access than globals for every frame
+    """
+    device_name = _SETTINGS.DEVICE_NAME
+    # Indexed by "value == 1", so anything but 1 maps to the OFF payload
+    value_payload = (_SETTINGS.MQTT_PAYLOAD_OFF, _SETTINGS.MQTT_PAYLOAD_ON)
+
+    def _ws_process(payload):
+        """Process incoming websocket payload, push to MQTT"""
+        obj = orjson.loads(payload)[0]
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug(
+                "Incoming message for websocket %s",
+                obj,
+                extra={"kind": LOG_KIND.WEBSOCKET},
+            )
+
+        topic = _state_topic(device_name, obj["dev"], obj["circuit"])
+        payload = value_payload[obj["value"] == 1]
+        publish(topic, payload=payload)
+        logger.info(
+            "MQTT publish %s to topic %s",
+            payload,
+            topic,
+            extra={"kind": LOG_KIND.WEBSOCKET},
         )
-    return _SETTINGS
 
+    return _ws_process
 
-async def _ws_process(payload):
-    """Process incoming websocket payload, push to MQTT"""
-    obj = json.loads(payload)[0]
-    logger.debug(
-        "Incoming message for websocket %s", obj, extra={"kind": LOG_KIND.WEBSOCKET}
-    )
 
-    topic = MQTT_TOPIC_FORMAT.format(
-        device_name=_settings().DEVICE_NAME,
-        dev=obj["dev"],
-        circuit=obj["circuit"],
-        hass_action=HASS_ACTION.STATE,
-    )
-    payload = (
-        _settings().MQTT_PAYLOAD_ON
-        if obj["value"] == 1
-        else _settings().MQTT_PAYLOAD_OFF
-    )
-    _mqtt_client().publish(topic, payload=payload)
-    logger.info(
-        "MQTT publish %s to topic %s",
-        payload,
-        topic,
-        extra={"kind": LOG_KIND.WEBSOCKET},
-    )
+async def _ws_reader(websocket):
+    """Read incoming events from websockets"""
+    ws_process = _make_ws_process(_mqtt_client().publish)
+    while True:
+        # recv returns already buffered frames without going through the event loop
+        payload = await websocket.recv()
+        ws_process(payload)
 
 
-async def _ws_loop():
-    """Main loop polling incoming events from websockets"""
-    logger.info(
-        "Connecting to %s",
-        _settings().WEBSOCKET_URI,
-        extra={"kind": LOG_KIND.WEBSOCKET},
-    )
-    async with websockets.connect(_settings().WEBSOCKET_URI) as websocket:
-        while True:
-            payload = await websocket.recv()
-            await _ws_process(payload)
+async def _ws_writer(websocket, ws_queue):
+    """Send queued, already serialized commands to websockets"""
+    while True:
+        msg = await ws_queue.get()
+        if ws_queue.empty():
+            await websocket.send(msg)
+            continue
 
+        # Burst of commands, e.g. restored states: send what is already queued
+        batch = [msg]
+        while not ws_queue.empty() and len(batch) < WS_SEND_BATCH_SIZE:
+            batch.append(ws_queue.get_nowait())
+        await asyncio.gather(*(websocket.send(frame) for frame in batch))
 
-async def _ws_trigger(dev, circuit, value):
-    """Send MQTT message to websocket"""
-    async with websockets.connect(_settings().WEBSOCKET_URI) as websocket:
-        await websocket.send(
-            json.dumps({"cmd": "set", "dev": dev, "circuit": circuit, "value": value})
-        )
+
+async def _ws_loop(ws_queue):
+    """Main loop polling incoming events from and sending commands to websockets"""
+    logger.info(
+        "Connecting to %s", _SETTINGS.WEBSOCKET_URI, extra={"kind": LOG_KIND.WEBSOCKET},
+    )
+    # Pings are disabled when there is no interval, else wait for the pong for two
+    # thirds of the interval, but at least a second
+    ping_interval = _SETTINGS.WEBSOCKET_PING_INTERVAL
+    ping_timeout = max(ping_interval * 2 // 3, 1) if ping_interval else None
+    # evok frames are small JSON messages, deflating them only costs CPU
+    async with websockets.connect(
+        _SETTINGS.WEBSOCKET_URI,
+        compression=None,
+        ping_interval=ping_interval,
+        ping_timeout=ping_timeout,
+    ) as websocket:
+        await asyncio.gather(_ws_reader(websocket), _ws_writer(websocket, ws_queue))
 
 
 def _mqtt_client():
     """Singleton MQTT client"""
     global _MQTT_CLIENT
     if _MQTT_CLIENT is None:
-        _MQTT_CLIENT = mqtt.Client(
-            client_id=_settings().DEVICE_NAME, clean_session=None
-        )
+        _MQTT_CLIENT = mqtt.Client(client_id=_SETTINGS.DEVICE_NAME, clean_session=None)
     return _MQTT_CLIENT
 
 
-def on_message(client, userdata, message):
-    """Callback for MQTT events"""
-    logger.info(
-        f"Incoming MQTT message for topic {message.topic} with payload {message.payload}",
-        extra={"kind": LOG_KIND.MQTT},
-    )
-    match = MQTT_COMMAND_TOPIC_REGEX.match(message.topic)
-    if match is None:
-        return
-
-    device_name = match.group("device_name")
-    dev = match.group("dev")
-    circuit = match.group("circuit")
-    if device_name != _settings().DEVICE_NAME:
-        logger.warning(
-            "Handling incoming message for device %s, expected %s",
-            device_name,
-            _settings().DEVICE_NAME,
+@functools.lru_cache(maxsize=1024)
+def _parse_command_topic(topic):
+    """
+    Split a command topic "{device_name}/{dev}/{circuit}/set" in its parts and
+    the matching state topic, returns None if the topic is not a command topic.
+    Results are cached, as the same few topics keep coming in.
+    """
+    parts = topic.split("/")
+    if len(parts) != 4 or parts[3] != HASS_ACTION.COMMAND:
+        return None
+    device_name, dev, circuit, _ = parts
+    if not device_name or dev not in MQTT_COMMAND_DEVS:
+        return None
+    if not circuit or circuit.strip("0123456789_"):
+        return None
+    return device_name, dev, circuit, _state_topic(device_name, dev, circuit)
+
+
+def _make_on_set_message(loop, ws_queue):
+    """
+    Build the callback for MQTT command topics with everything it needs bound as
+    closure variables, which are faster to access than globals for every message
+    """
+    payload_map = {_SETTINGS.MQTT_PAYLOAD_ON: 1, _SETTINGS.MQTT_PAYLOAD_OFF: 0}
+
+    def on_set_message(client, userdata, message):
+        """Callback for MQTT events on command topics"""
+        logger.info(
+            "Incoming MQTT message for topic %s with payload %s",
+            message.topic,
+            message.payload,
             extra={"kind": LOG_KIND.MQTT},
         )
+        parsed = _parse_command_topic(message.topic)
+        if parsed is None:
+            return
+
+        _, dev, circuit, state_topic = parsed
+
+        # Update state topic
+        client.publish(state_topic, message.payload)
+
+        # Send to websocket
+        value = payload_map.get(message.payload, 0)
+        logger.info(
+            "Push to output %s, %s, %s",
+            dev,
+            circuit,
+            value,
+            extra={"kind": LOG_KIND.WEBSOCKET},
+        )
+        # on_set_message runs in the paho thread: serialize here, so the websocket event
+        # loop only has to send. evok expects text frames, orjson returns bytes.
+        msg = orjson.dumps(
+            {"cmd": "set", "dev": dev, "circuit": circuit, "value": value}
+        )
+        loop.call_soon_threadsafe(ws_queue.put_nowait, msg.decode())
 
-    # Update state topic
-    client.publish(
-        MQTT_TOPIC_FORMAT.format(
-            device_name=device_name,
-            dev=dev,
-            circuit=circuit,
-            hass_action=HASS_ACTION.STATE,
-        ),
-        message.payload,
-    )
-
-    # Send to websocket
-    value = 1 if message.payload == _settings().MQTT_PAYLOAD_ON else 0
-    logger.info(
-        f"Push to output {dev}, {circuit}, {value}", extra={"kind": LOG_KIND.WEBSOCKET}
-    )
-    asyncio.run(_ws_trigger(dev, circuit, value))
+    return on_set_message
 
 
 def on_connect(client, userdata, message, rc):
     """Callback for when MQTT connection to broker is set up"""
+    # Small publishes should go out right away instead of waiting for Nagle;
+    # done here so it gets applied again after a reconnect
+    client.socket().setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
     logger.debug("Subscribe to all command topics", extra={"kind": LOG_KIND.MQTT})
-    client.subscribe("{device_name}/#".format(device_name=_settings().DEVICE_NAME))
+    client.subscribe(_SUBSCRIBE_TOPIC)
 
 
 def _parser():
@@ -206,45 +283,103 @@ def _parser():
     parser = argparse.ArgumentParser()
     parser.add_argument("mqtt_host", help="MQTT broker host")
     parser.add_argument("--mqtt_port", type=int, default=1883)
-    parser.add_argument("--mqtt_payload_on", default=b"ON")
-    parser.add_argument("--mqtt_payload_off", default=b"OFF")
+    parser.add_argument(
+        "--mqtt_keepalive",
+        help="Seconds between MQTT keepalive pings",
+        type=int,
+        default=120,
+    )
+    # Payloads are encoded once, paho hands over incoming payloads as bytes
+    parser.add_argument("--mqtt_payload_on", type=str.encode, default=b"ON")
+    parser.add_argument("--mqtt_payload_off", type=str.encode, default=b"OFF")
     parser.add_argument(
         "--device_name",
-        help="Unique name for unipi neuron device",
-        default=socket.gethostname(),
+        help="Unique name for unipi neuron device, defaults to the hostname",
     )
     parser.add_argument(
         "--websocket_uri", help="neuron websocket URI", default="ws://localhost/ws"
     )
+    parser.add_argument(
+        "--ws_ping_interval",
+        help="Seconds between websocket keepalive pings, 0 disables them",
+        type=int,
+        default=30,
+    )
+    parser.add_argument(
+        "--log_level",
+        help="Log level, use INFO to log every message",
+        choices=("DEBUG", "INFO", "WARNING", "ERROR"),
+        default=logging.getLevelName(LOG_LEVEL),
+    )
     return parser
 
 
+async def _main_async():
+    """Set up the MQTT client and run the websocket loop on the running loop"""
+    # Event loop and command queue need to exist before any MQTT message comes in
+    loop = asyncio.get_running_loop()
+    ws_queue = asyncio.Queue()
+
+    # MQTT initial setup
+    logger.info(
+        "Connecting to MQTT broker %s",
+        _SETTINGS.MQTT_HOST,
+        extra={"kind": LOG_KIND.MQTT},
+    )
+    _mqtt_client().on_connect = on_connect
+    # Blocking connect, don't hold up the event loop with it
+    await loop.run_in_executor(
+        None,
+        functools.partial(
+            _mqtt_client().connect,
+            _SETTINGS.MQTT_HOST,
+            _SETTINGS.MQTT_PORT,
+            keepalive=_SETTINGS.MQTT_KEEPALIVE,
+        ),
+    )
+    # paho's topic matcher only hands over messages for our own command topics
+    _mqtt_client().message_callback_add(
+        _SUBSCRIBE_TOPIC, _make_on_set_message(loop, ws_queue)
+    )
+
+    # Loop
+    logger.info("Starting websocket poll loop", extra={"kind": LOG_KIND.WEBSOCKET})
+    _mqtt_client().loop_start()
+    await _ws_loop(ws_queue)
+
+
 def main():
     # Parse
-    args = _parser().parse_args()
+    parser = _parser()
+    args = parser.parse_args()
+    if args.ws_ping_interval < 0:
+        parser.error("--ws_ping_interval can't be negative")
+    logging.getLogger().setLevel(args.log_level)
 
     # Set settings first time and don't change them anymore
     _set_settings(
         args.mqtt_host,
         args.mqtt_port,
+        args.mqtt_keepalive,
         args.mqtt_payload_on,
         args.mqtt_payload_off,
-        args.device_name,
+        args.device_name or socket.gethostname(),
         args.websocket_uri,
+        args.ws_ping_interval or None,
     )
 
-    # MQTT initial setup
-    logger.info(
-        "Connecting to MQTT broker %s", args.mqtt_host, extra={"kind": LOG_KIND.MQTT}
-    )
-    _mqtt_client().on_message = on_message
-    _mqtt_client().on_connect = on_connect
-    _mqtt_client().connect(_settings().MQTT_HOST, _settings().MQTT_PORT, 60)
+    # Use the faster uvloop event loop when it is available (Linux/macOS only)
+    try:
+        import uvloop
 
-    # Loop
-    logger.info("Starting websocket poll loop", extra={"kind": LOG_KIND.WEBSOCKET})
-    _mqtt_client().loop_start()
-    asyncio.get_event_loop().run_until_complete(_ws_loop())
+        uvloop.install()
+    except ImportError:
+        logger.debug(
+            "uvloop not available, using default event loop",
+            extra={"kind": LOG_KIND.WEBSOCKET},
+        )
+
+    asyncio.run(_main_async())
 
 
 if __name__ == "__main__":
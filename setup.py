@@ -5,7 +5,12 @@ setup(
     version="0.1",
     description="Translate evok websocket messages to MQTT",
     url="https://github.com/mhemeryck/evok2mqtt",
-    install_requires=("websockets>=8.1", "paho-mqtt>=1.5"),
+    install_requires=(
+        "websockets>=8.1",
+        "paho-mqtt>=1.5",
+        "orjson>=3.4",
+        'uvloop>=0.14; sys_platform != "win32"',
+    ),
     author="Martijn Hemeryck",
     license="MIT",
     packages=["evok2mqtt"],